@@ -6,9 +6,9 @@
 #
 # nm3210@gmail.com
 # Date Created:  June 12th, 2021 (after testing for a few weeks)
-# Last Modified: June 12th, 2021
+# Last Modified: October 15th, 2026
 
-import os, sys, collections, time # circuitpython built-ins
+import os, sys, time # circuitpython built-ins
 try:
     cwd = os.path.dirname(os.path.realpath(__file__))
 except:
@@ -17,169 +17,313 @@ sys.path.append(cwd) # make sure this folder is in the path
 from crc import crc
 
 _specialFirstBinChars = b'c0ffee'
-_numBinChars = 2 # 0x00 to 0xff
+_wireFormatVersion = 2 # v1 used ascii hex for the bin info and CRC
+_numBinChars = 1 # 0x00 to 0xff, as a single raw byte
+_numCrcChars = 2 # raw big-endian CRC-16
+
+# Header offsets, derived once here rather than on every call
+_numSpecialChars = len(_specialFirstBinChars)
+_numBinsLoc = _numSpecialChars + 1 # after the version byte
+_firstIndexBinLoc = _numBinsLoc + _numBinChars
+_firstContentLoc = _firstIndexBinLoc + _numBinChars
 
 def packPayload(dataIn, maxLen=32):
     """
     This 'packPayload' will split the input data into individual 'packets'/bins
     that are then reassembled by the associated 'receivePayload' and
-    'unpackPayloadBin' functions back into the original input.
+    'unpackPayloadBin' functions back into the original input. The input is
+    normally bytes (what the radio sends anyway), but a str is also accepted
+    and just gets encoded up front.
     
     The packing mechanism first adds a special sequence of characters to the
     first bin (by default using the six chars in 'c0ffee') so that the receiver
     will know which bin will contain the total number of expected bins. Then it
-    will add the aforementioned number of expected bins to be received to the
-    string. And finally, a CRC value gets added to the end of the string for
-    transmission assurance.
+    will add the wire format version and the aforementioned number of expected
+    bins to be received. And finally, a CRC value gets added to the end of the
+    data for transmission assurance.
     
     The specific format is
-        Bin#0: [SpecialChars] [NumBins] [BinIdx0] <content>
+        Bin#0: [SpecialChars] [Version] [NumBins] [BinIdx0] <content>
         Bin#1: [BinIdx1] <content>
         Bin#2: [BinIdx2] <content>
         Bin#N: [BinIdxN] <content> [CRC]
+    where the version, num bins and bin indices are single raw bytes and the
+    CRC is two raw bytes (big-endian). The CRC only covers the content, so
+    neither side ever hashes the header bytes.
         
     Note that many short-length inputs will just be within a single bin
-        Bin#0: [SpecialChars] [NumBins] [BinIdx0] <content> [CRC]
+        Bin#0: [SpecialChars] [Version] [NumBins] [BinIdx0] <content> [CRC]
     
     Specific examples/usages
-        packPayload('A') => [b'c0ffee0100A9479']
-        packPayload('123456789') => [b'c0ffee0100123456789e5cc']
-        packPayload('123456789'*7) => [b'c0ffee03001234567891234567891234', 
-            b'01567891234567891234567891234567', b'028912345678912345678925ba']
+        packPayload('A') => [bytearray(b'c0ffee\\x02\\x01\\x00A\\x94y')]
+        packPayload('123456789') => [bytearray(b'c0ffee\\x02\\x01\\x00123456789\\xe5\\xcc')]
+        packPayload('123456789'*7) => [bytearray(b'c0ffee\\x02\\x03\\x0012345678912345678912345'),
+            bytearray(b'\\x016789123456789123456789123456789'),
+            bytearray(b'\\x02123456789\\x9b\\xb1')]
     """
-    # Add packet header information
-    numSpecialChars = len(_specialFirstBinChars)
-    binFormat = b'%%0%dx'%_numBinChars # convert to hex
+    if maxLen < _firstContentLoc:
+        raise ValueError('maxLen of %d is too short for the %d byte first bin header' % (maxLen, _firstContentLoc))
     
-    # Calculate CRC
-    crcVal = b'%04x'%crc(dataIn) # convert to hex
+    # Calculate CRC (over the encoded bytes, so a str input is only encoded once)
+    dataBytes = dataIn.encode() if isinstance(dataIn, str) else dataIn
+    crcVal = crc(dataBytes)
     
-    # Prefix input data with header info
-    dataWithHeader = _specialFirstBinChars + '_'*_numBinChars + dataIn + crcVal
+    # The content (the data followed by its CRC) gets spread across bins, with
+    # less room in the first bin because of the header (many short inputs will
+    # fit entirely within that first bin)
+    numChars = len(dataBytes)
+    numContentChars = numChars + _numCrcChars
+    firstBinSize = maxLen - _firstContentLoc
     binSize = maxLen - _numBinChars
+    numBins = 1 + max(0, numContentChars - firstBinSize + binSize - 1) // binSize
+    if numBins > 0xff:
+        raise ValueError('Payload needs %d bins, more than the max of 255' % numBins)
+    crcBytes = bytes((crcVal >> 8, crcVal & 0xff))
     
-    # Split string into individual packets/bins
-    splitPackets = [dataWithHeader[i:i+binSize] for i in range(0, len(dataWithHeader), binSize)]
-
-    # Fill in num bin info
-    firstIndexBinLoc = (numSpecialChars+_numBinChars)
-    splitPackets[0] = splitPackets[0][:numSpecialChars] + binFormat%len(splitPackets) + splitPackets[0][firstIndexBinLoc:]
-
-    # Fill in bin index
-    for index, curPacket in enumerate(splitPackets):
-        if index == 0:
-            splitPackets[index] = splitPackets[index][:firstIndexBinLoc] + binFormat%index + splitPackets[index][firstIndexBinLoc:]
-        else:
-            splitPackets[index] = binFormat%index + splitPackets[index]
+    # Allocate each bin once at its final size and write the bin index and its
+    # share of the data/CRC straight into it (copying the data via a memoryview)
+    dataView = memoryview(dataBytes)
+    splitPackets = []
+    startIdx = 0
+    for index in range(numBins):
+        contentLoc = _firstContentLoc if index == 0 else _numBinChars
+        stopIdx = min(startIdx + maxLen - contentLoc, numContentChars)
+        curPacket = bytearray(contentLoc + stopIdx - startIdx)
+        curPacket[contentLoc-_numBinChars] = index
+        if startIdx < numChars:
+            dataStopIdx = min(stopIdx, numChars)
+            curPacket[contentLoc:contentLoc+dataStopIdx-startIdx] = dataView[startIdx:dataStopIdx]
+        if stopIdx > numChars:
+            crcStartIdx = max(startIdx, numChars)
+            curPacket[contentLoc+crcStartIdx-startIdx:] = crcBytes[crcStartIdx-numChars:stopIdx-numChars]
+        splitPackets.append(curPacket)
+        startIdx = stopIdx
+    
+    # Fill in the first bin's header info
+    firstPacket = splitPackets[0]
+    firstPacket[:_numSpecialChars] = _specialFirstBinChars
+    firstPacket[_numSpecialChars] = _wireFormatVersion
+    firstPacket[_numBinsLoc] = numBins
     return splitPackets
 
 def unpackPayloadBin(binData, debugPrint=False):
+    """
+    Pull the content, bin index and (for the first bin only, otherwise None)
+    number of bins out of a single received bin. The bin is the bytes or
+    bytearray straight from nrf.read() and is never decoded, so the header is
+    always compared bytes to bytes and the content is returned as bytes.
+    Returns None for a bin too short to hold its header, or for a first bin
+    packed with a different wire format.
+    
+    Specific examples/usages
+        unpackPayloadBin(b'c0ffee\\x02\\x03\\x00123') => (b'123', 0, 3)
+        unpackPayloadBin(b'\\x01456') => (b'456', 1, None)
+    """
     # Look for first bin special chars and pull out the number of bins
-    binData = binData.decode() if type(binData) is bytearray or type(binData) is bytes else binData
     numBins = None
-    if binData.startswith(_specialFirstBinChars): # first bin check
-        numBins = int(binData[len(_specialFirstBinChars):len(_specialFirstBinChars)+_numBinChars],16)
+    if binData[:_numSpecialChars] == _specialFirstBinChars: # first bin check
+        # Skip over first bins cut short or packed with a different wire format
+        if len(binData) < _firstContentLoc:
+            if debugPrint:
+                print('First bin is too short to hold its header: {}'.format(binData))
+            return None
+        if binData[_numSpecialChars] != _wireFormatVersion:
+            if debugPrint:
+                print('Unsupported wire format version in first bin: {}'.format(binData))
+            return None
+        numBins = binData[_numBinsLoc]
+        
+    elif len(binData) < _numBinChars:
+        if debugPrint:
+            print('Bin is too short to hold its index: {}'.format(binData))
+        return None
         
     # Pull out index for each bin
-    binIdxLoc = len(_specialFirstBinChars)+_numBinChars if numBins is not None else 0
-    binIdxVal = int(binData[binIdxLoc:binIdxLoc+_numBinChars],16)
+    binIdxLoc = _firstIndexBinLoc if numBins is not None else 0
+    binIdxVal = binData[binIdxLoc]
     
-    # Snip out contents
+    # Snip out contents as bytes (so they can be joined back together), going
+    # through a memoryview so a bytearray from the radio is only copied once
     startIdx = binIdxLoc + _numBinChars
-    stopIdx = len(binData)
-    payloadContent = binData[startIdx:stopIdx]
+    payloadContent = bytes(memoryview(binData)[startIdx:])
     
     # Assemble output: [payloadContent, binIdxVal, numBins]
     return payloadContent, binIdxVal, numBins
 
-def receivePayload(nrfRef, timeoutDur=0.1, updateDur=0.1, debugPrint=False):
+def receivePayload(nrfRef, timeoutDur=0.1, updateDur=0.1, debugPrint=False, irqPin=None):
     """
     Automatically parse multiple consecutive payloads packed via `packPayload`
     and sent over a link with nrf.send(payload). There is a healthy bit of
     validation for CRC values and the expected number of bins within the first
     packet/bin to make sure 
     
+    By default the radio is checked for new packets every 'updateDur' seconds.
+    If the radio's IRQ pin is wired up, pass it in as 'irqPin' (e.g. board.D5)
+    to instead wake up as soon as the radio flags a received packet.
+    
+    The payload is returned as bytes (use 'receivePayloadStr' to get a str),
+    or None if it could not be received intact.
+    
     Specific examples/usages
-        Received packets: [b'c0ffee0100A9479']
-        Output = 'A'
+        Received packets: [bytearray(b'c0ffee\\x02\\x01\\x00A\\x94y')]
+        Output = b'A'
         
-        Received packets: [b'c0ffee0100123456789e5cc']
-        Output = '123456789'
+        Received packets: [bytearray(b'c0ffee\\x02\\x01\\x00123456789\\xe5\\xcc')]
+        Output = b'123456789'
         
-        Received packets: [b'c0ffee03001234567891234567891234', 
-            b'01567891234567891234567891234567', b'028912345678912345678925ba']
-        Output = '123456789123456789123456789123456789123456789123456789123456789'
+        Received packets: [bytearray(b'c0ffee\\x02\\x03\\x0012345678912345678912345'),
+            bytearray(b'\\x016789123456789123456789123456789'),
+            bytearray(b'\\x02123456789\\x9b\\xb1')]
+        Output = b'123456789123456789123456789123456789123456789123456789123456789'
     
     """
     # Start a new receive payload set
-    receivedPayloadBins = {} # dict
+    receivedPayloadBins = None # one slot per bin, allocated with the first bin
+    numReceivedBins = 0
     numExpectedBins = None
     
+    # Cache lookups used on every pass of the receive loop
+    monotonic_ns = time.monotonic_ns
+    available = nrfRef.available
+    timeoutNs = timeoutDur*1e9
+    
+    # Optionally watch the radio's (active low) IRQ line instead of sleeping
+    irq = None
+    if irqPin is not None:
+        import digitalio # only needed when an IRQ pin is wired up
+        irq = digitalio.DigitalInOut(irqPin)
+        irq.switch_to_input(pull=digitalio.Pull.UP)
+    
     # Setup timeout
-    startTimer = time.monotonic_ns() # start timer
-    
-    # Continually look for transmitted data
-    while len(receivedPayloadBins) is not numExpectedBins:
-        # Check for timeout
-        if time.monotonic_ns() > startTimer + timeoutDur*1e9:
-            if debugPrint == True:
-                print("Timeout reached")
-            break
+    startTimer = monotonic_ns() # start timer
+    
+    # Enable listen processing (high power usage for some reason) for the whole
+    # receive, rather than bouncing in and out of RX mode between checks
+    nrfRef.listen = True
+    
+    try:
+        # Continually look for transmitted data
+        while numReceivedBins != numExpectedBins:
+            # Check for timeout
+            if monotonic_ns() > startTimer + timeoutNs:
+                if debugPrint:
+                    print("Timeout reached")
+                break
         
-        # Listen for data
-        nrfRef.listen = True # enable listen processing (high power usage for some reason)
-        time.sleep(updateDur) # allow listening on the radio for a while
-        nrfRef.listen = False # disable listen processing (back to standby power)
-        if not nrfRef.available():
-            continue
+            # Listen for data (packets already queued in the RX FIFO are read
+            # without waiting, so a burst can't overflow the 3-deep FIFO)
+            if irq is None:
+                if not available():
+                    time.sleep(updateDur) # allow listening on the radio for a while
+            else:
+                # The IRQ line only drops when a new packet lands, so it can't be
+                # used to tell whether the FIFO still holds earlier packets
+                while irq.value and not available() and monotonic_ns() <= startTimer + timeoutNs:
+                    time.sleep(0.001) # wait for the IRQ line to drop
+            if not available():
+                if irq is not None and not irq.value:
+                    nrfRef.clear_status_flags() # stale flag, release the IRQ line
+                continue
         
-        # grab information about the received payload
-        payload_size, pipe_number = (nrfRef.any(), nrfRef.pipe)
+            # grab information about the received payload
+            payload_size, pipe_number = (nrfRef.any(), nrfRef.pipe)
         
-        # Pull out any received data
-        buffer = nrfRef.read() # also clears nrfRef.irq_dr status flag
+            # Pull out any received data
+            buffer = nrfRef.read() # also clears nrfRef.irq_dr status flag
         
-        if debugPrint == True:
-            print("Received {} bytes on pipe {}: {}".format(
-                payload_size, pipe_number, buffer))
+            if debugPrint:
+                print("Received {} bytes on pipe {}: {}".format(
+                    payload_size, pipe_number, buffer))
                 
-        # Unpack payload
-        payloadContent, binIdxVal, numBins = unpackPayloadBin(buffer, debugPrint)
+            # Unpack payload
+            unpackedBin = unpackPayloadBin(buffer, debugPrint)
+            if unpackedBin is None:
+                continue
+            payloadContent, binIdxVal, numBins = unpackedBin
         
-        # Check for total number of bins
-        if numBins is not None: # in the first payload
-            numExpectedBins = numBins
-            
-            # Check if the receivedPayloadBins already has content
-            if numExpectedBins < len(receivedPayloadBins):
-                receivedPayloadBins = {} # reset
+            # Reset timer now that a new packet has been detected
+            startTimer = monotonic_ns() # start timer
         
-        # Add/update payload
-        receivedPayloadBins[binIdxVal] = payloadContent
+            # Check for total number of bins
+            if numBins is not None: # in the first payload
+                # Start a new set of slots unless this is a repeat of the first bin
+                if numBins != numExpectedBins:
+                    numExpectedBins = numBins
+                    receivedPayloadBins = [None]*numExpectedBins
+                    numReceivedBins = 0
         
-        # Reset timer now that a new packet has been detected
-        startTimer = time.monotonic_ns() # start timer
+            # Add/update payload (bins before the first bin have nowhere to go yet)
+            if receivedPayloadBins is None or binIdxVal >= numExpectedBins:
+                continue
+            if receivedPayloadBins[binIdxVal] is None:
+                numReceivedBins += 1
+            receivedPayloadBins[binIdxVal] = payloadContent
+
+    finally:
+        # Disable listen processing (back to standby power) and release the IRQ
+        # pin, even if the loop was interrupted, so the radio isn't left in high
+        # power RX mode and the pin isn't left claimed
+        nrfRef.listen = False
+        if irq is not None:
+            irq.deinit() # release the pin for the next receive
     
-    # Pull out all the contents
-    receivedPayloadBins = collections.OrderedDict(sorted(receivedPayloadBins.items())) # sort
-    totalPayload = ''.join(list(receivedPayloadBins.values()))
+    # Pull out all the contents (the slots are already in bin order)
+    if numReceivedBins != numExpectedBins:
+        if debugPrint:
+            print('Payload is missing bins')
+        return None
+    totalPayload = b''.join(receivedPayloadBins)
+    if len(totalPayload) < _numCrcChars:
+        if debugPrint:
+            print('Payload is too short to contain a CRC')
+        return None
     
     # Extract the CRC
-    payloadCrc = totalPayload[-4:]
-    totalPayload = totalPayload[:-4]
+    payloadCrc = (totalPayload[-2] << 8) | totalPayload[-1]
+    totalPayload = totalPayload[:-_numCrcChars]
     
     # Check whether contents match CRC
-    calculatedCrc = '%04x'%crc(totalPayload)
-    payloadCrc = payloadCrc.decode() if type(payloadCrc) is bytearray or type(payloadCrc) is bytes else payloadCrc
-    calculatedCrc = calculatedCrc.decode() if type(calculatedCrc) is bytearray or type(calculatedCrc) is bytes else calculatedCrc
+    calculatedCrc = crc(totalPayload)
     if payloadCrc != calculatedCrc:
-        if debugPrint == True:
-            print('Payload''s CRC (%s) does not match calculated CRC (%s)' % (payloadCrc, calculatedCrc))
+        if debugPrint:
+            print('Payload''s CRC (%04x) does not match calculated CRC (%04x)' % (payloadCrc, calculatedCrc))
         return None
     
     # Return payload
     return totalPayload
 
+def receivePayloadStr(nrfRef, *args, **kwargs):
+    """
+    Same as 'receivePayload', but decodes the received payload into a str.
+    """
+    payload = receivePayload(nrfRef, *args, **kwargs)
+    return payload.decode() if payload is not None else None
+
+class NrfPowered:
+    """
+    Context manager that powers up the radio in transmit mode for a burst of
+    'sendPayload' calls, so the radio doesn't go through its power up settling
+    time for every payload. The previous power/listen state is restored on
+    exit (by default this means powering the radio back down).
+    
+    Specific examples/usages
+        with NrfPowered(nrf):
+            sendPayload(nrf, 'A')
+            sendPayload(nrf, '123456789')
+    """
+    def __init__(self, nrfRef):
+        self.nrfRef = nrfRef
+    
+    def __enter__(self):
+        self.prevPower, self.prevListen = (self.nrfRef.power, self.nrfRef.listen)
+        self.nrfRef.power = True
+        self.nrfRef.listen = False
+        return self.nrfRef
+    
+    def __exit__(self, excType, excValue, traceback):
+        self.nrfRef.listen = self.prevListen
+        self.nrfRef.power = self.prevPower
+
 def sendPayload(nrfRef, payload, debugPrint=False, numRetries=10):
     # Configure the module to transmit
     nrfRef.power = True
@@ -187,20 +331,20 @@ def sendPayload(nrfRef, payload, debugPrint=False, numRetries=10):
     
     # Attempt to send the payload
     packedPayload = packPayload(payload)
-    if debugPrint == True:
+    if debugPrint:
         print(f'Attempting to transmit payload \'{payload}\'')
         print(packedPayload)
     gotAckBack = nrfRef.send(packedPayload, force_retry=numRetries)
     
     # Check whether the send was 'successful' (got an ack back)
-    if debugPrint == True:
+    if debugPrint:
         if gotAckBack == True:
             print(f'  Succesfully transmitted payload \'{payload}\' (received ack back)')
         else:
             print(f'  No ack was received back for payload \'{payload}\'')
     
-    # Disable the module to conserve power
-    nrfRef.power = False
+    # The module is left powered up so back-to-back sends skip the power up
+    # settling time; use 'NrfPowered' to power it down after a burst
     
     # Return value of whether an ack was received back
     return gotAckBack
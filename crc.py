@@ -3,10 +3,16 @@
 # 
 # nm3210@gmail.com
 # Date Created:  June 12th, 2021
-# Last Modified: June 12th, 2021
+# Last Modified: October 15th, 2026
 
-_CRC_POLYNOMIAL = 0x1021
-_CRC_PRESET = 0x1D0F
+import array
+try:
+    from micropython import const # lets the compiler inline the constants
+except ImportError:
+    const = lambda x: x
+
+_CRC_POLYNOMIAL = const(0x1021)
+_CRC_PRESET = const(0x1D0F)
 
 def _initial(c):
     crc = 0
@@ -17,9 +23,25 @@ def _initial(c):
         else:
             crc = crc << 1
         c = c << 1
-    return crc
+    return crc & 0xffff # the bits above 16 get masked off in use anyway
+
+# Unsigned 16-bit array (512 bytes) rather than a list of 256 int objects
+_crcTable = array.array('H', (_initial(i) for i in range(256)))
+
+def _sliceTables(numTables):
+    # Each table pushes every entry of the previous one through the CRC by one
+    # more (zero) byte
+    tables = [ _crcTable ]
+    for _ in range(1, numTables):
+        tables.append(array.array('H', (((t << 8) & 0xffff) ^ _crcTable[t >> 8] for t in tables[-1])))
+    return tables
 
-_crcTable = [ _initial(i) for i in range(256) ]
+# Slice-by-8 tables, where _crcTables[k][i] is the CRC contribution of byte i
+# followed by k more bytes (so _crcTables[0] is just _crcTable). Note this
+# trades memory for speed: the seven extra tables take another 3.5 KB of heap
+# at import, which is more than storing _crcTable as an array saves over a list
+# on the smaller CircuitPython boards.
+_crcTables = _sliceTables(8)
 
 def _update_crc(crc, c):
     cc = 0xff & c
@@ -29,9 +51,27 @@ def _update_crc(crc, c):
     return crc
 
 def crc(strIn):
+    # Accept str or any bytes-like input; a str is encoded once up front so the
+    # loop below works on plain ints instead of calling ord() per character
+    if isinstance(strIn, str):
+        strIn = strIn.encode()
+    
+    # Tables bound to locals (cheaper than a global lookup per byte)
+    t0, t1, t2, t3, t4, t5, t6, t7 = _crcTables
     crc = _CRC_PRESET
-    for c in strIn:
-        crc = _update_crc(crc, ord(c))
+    
+    # Slice-by-8: fold 8 bytes per pass with one lookup per byte, where the
+    # 16-bit CRC only mixes into the first two bytes of each slice
+    numChars = len(strIn)
+    end8 = numChars - numChars % 8
+    for i in range(0, end8, 8):
+        crc = (t7[strIn[i] ^ (crc >> 8)] ^ t6[strIn[i+1] ^ (crc & 0xff)] ^
+               t5[strIn[i+2]] ^ t4[strIn[i+3]] ^ t3[strIn[i+4]] ^
+               t2[strIn[i+5]] ^ t1[strIn[i+6]] ^ t0[strIn[i+7]])
+    
+    # Table update inlined from '_update_crc' for the leftover bytes
+    for i in range(end8, numChars):
+        crc = ((crc << 8) ^ t0[((crc >> 8) ^ strIn[i]) & 0xff]) & 0xffff
     return crc
 
 def crcb(*i):